@@ -6,17 +6,47 @@ This class handles the JSON file objects.
 """
 
 import os
+import copy
 import json
-from pathlib import Path
+import mmap
 import logging
-import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import pandas as pd
 from .s3 import S3
 from .log import setup_custom_logger
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _stdlib_json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    """Serialize with orjson, falling back to the standard library for the
+    integers beyond 64 bits that orjson rejects. NaN and infinity are written
+    as null."""
+
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    except orjson.JSONEncodeError:
+        return _stdlib_json_dumps(obj)
+
+
+_json_dumps = _stdlib_json_dumps if orjson is None else _orjson_dumps
+
+
 class FileUploadError(Exception):
+    """Raised when a file fails to upload to the remote. The message is only
+    formatted when the exception is displayed."""
+
     def __init__(self, filename, filepath, message=None):
+        super().__init__(filename, filepath, message)
         self.filename = filename
         self.filepath = filepath
         self.message = message
@@ -25,14 +55,29 @@ class FileUploadError(Exception):
         return 'Upload failed for File {} upload to {}. {}'.format(
             self.filename,
             self.filepath,
-            None
-        )
+            self.message or ''
+        ).rstrip()
 
 
 class Filly():
     """A class to read and write various data types"""
 
-    def __init__(self, remote=None, bucket_name=None):
+    CSV_CHUNKSIZE = 1_000_000
+    CSV_BLOCK_SIZE = 64 << 20
+    MAX_WORKERS = 16
+
+    _HANDLERS = {
+        '.json': '_json_handler',
+        '.csv': '_csv_handler',
+        '.pkl': '_pickle_handler',
+        '.pickle': '_pickle_handler',
+        '.parquet': '_parquet_handler',
+        '.pq': '_parquet_handler',
+        '.feather': '_arrow_handler',
+        '.arrow': '_arrow_handler',
+    }
+
+    def __init__(self, remote=None, bucket_name=None, hdfs_host='default', hdfs_port=0):
         """Class to handle the reading, writing, transpose and syncing of various file types
 
         Arguments:
@@ -41,6 +86,9 @@ class Filly():
                 the associated remote directory under the given filename. Only `s3` and `hdfs`
                 are supported at the moment.
             bucket_name (str): s3 bucket name if the remote location is set as s3.
+            hdfs_host (str): default to 'default', which uses the namenode from the
+                Hadoop configuration. Only used if the remote location is set as hdfs.
+            hdfs_port (int): default to 0, the namenode port when `hdfs_host` is set.
 
         Attributes:
             logger (logging.Logger): class logger
@@ -49,6 +97,7 @@ class Filly():
             fullpath (str): full file path plus the file name
             data ([dict, pd.DataFrame]): the read data if mode is "r", otherwise not available
             s3 (s3.S3): the S3 class that handles s3 up/downloading
+            hdfs (pyarrow.fs.HadoopFileSystem): the HDFS connection, if the remote is hdfs
 
         .. todo::
             Add chunking, progress bar and all that goodness for read/write pandas
@@ -56,6 +105,10 @@ class Filly():
 
         self.logger = setup_custom_logger(__name__)
         self.remote = remote
+        self._keep_local = True
+        self._buffer = None
+        self._ensured_dirs = set()
+        self._handler = None
 
         if self.remote not in ['s3', 'hdfs', None]:
             raise ValueError(f'Invalid remote {self.remote}. Only `hdfs` or `s3` are supported.')
@@ -66,6 +119,10 @@ class Filly():
             else:
                 raise ValueError(f'Please supply your s3 bucket name.')
 
+        if self.remote == 'hdfs':
+            from pyarrow import fs
+            self.hdfs = fs.HadoopFileSystem(hdfs_host, hdfs_port)
+
     def __set_path(self, filepath, filename, fullpath=None):
         if fullpath is not None:
             self.fullpath = fullpath
@@ -78,80 +135,206 @@ class Filly():
                 self.filepath = filepath
                 self.fullpath = os.path.join(filepath, filename)
 
-    def __run_cmd(self, args_list):
-        """ Run linux commands """
+        if fullpath is not None or filename is not None:
+            # Bind the file type handler once per path rather than per call
+            self._handler = self._HANDLERS.get(os.path.splitext(self.filename)[1].lower())
+
+    def _check_handler(self):
+        """Raise a TypeError if the current file type has no handler"""
+
+        if self._handler is None:
+            file_extension = os.path.splitext(self.filename)[1]
+            raise TypeError(f'File type: {file_extension} not supported')
 
-        self.logger.info('Running system command: {0}'.format(' '.join(args_list)))
-        proc = subprocess.Popen(args_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        s_output, s_err = proc.communicate()
-        s_return = proc.returncode
+    def _ensure_dir(self):
+        """Create the local filepath unless it has already been created"""
 
-        return s_return, s_output, s_err
+        if self.filepath not in self._ensured_dirs:
+            if self.filepath:
+                os.makedirs(self.filepath, exist_ok=True)
+            self._ensured_dirs.add(self.filepath)
 
-    def write_data(self, data, filepath=None, filename=None, fullpath=None):
+    def write_data(self, data, filepath=None, filename=None, fullpath=None, keep_local=True,
+                   buffer=None):
+        """Write the data to file, uploading it to the remote afterwards if set
+
+        Arguments:
+            data (dict, pd.DataFrame): data to be written
+            filepath (str): filepath, without the actual filename
+            filename (str): filename, without the file path
+            fullpath (str): full file path plus the file name, used instead of
+                filepath and filename
+            keep_local (bool): default to True. If False and the remote is s3,
+                the data is streamed straight into an s3 multipart upload and
+                no local copy is written.
+            buffer (io.BufferedIOBase): default to None. If supplied, the data is
+                serialized into this binary file object, e.g. an `io.BytesIO`,
+                instead of a file. The filename is still needed to pick the file
+                type, and nothing is uploaded to the remote.
+        """
 
         self.__set_path(filepath, filename, fullpath)
+        self._check_handler()
 
-        if not os.path.exists(self.filepath):
-            os.makedirs(self.filepath, exist_ok=True)
+        if buffer is not None:
+            self._buffer = buffer
+            try:
+                self._read_or_write(mode='w', data=data)
+            finally:
+                self._buffer = None
+            return
+
+        self._keep_local = keep_local or self.remote != 's3'
+
+        if self._keep_local:
+            self._ensure_dir()
 
         self._read_or_write(mode='w', data=data)
 
         if self.remote == 'hdfs':
-            self._upload_to_hdfs(hdfs_dir)
+            self._upload_to_hdfs(self.filepath)
         elif self.remote == 's3':
-            self.s3.put_to_s3(self.filepath, self.filepath, self.filename)
+            if self._keep_local:
+                self.s3.put_to_s3(self.filepath, self.filepath, self.filename)
         elif self.remote is None:
             pass
         else:
             raise ValueError(f'Invalid remote {self.remote}. Only `hdfs` or `s3` are supported.')
 
-    def read_data(self, filepath=None, filename=None, fullpath=None, download=True):
+    def read_data(self, filepath=None, filename=None, fullpath=None, download=True, **kwargs):
+        """Read the file into Filly.data, downloading it from the remote first if set
+
+        Arguments:
+            filepath (str): filepath, without the actual filename
+            filename (str): filename, without the file path
+            fullpath (str): full file path plus the file name, used instead of
+                filepath and filename
+            download (bool): default to True. Download the file from the remote
+                location before reading it.
+            **kwargs: reader options passed on to the file type handler, e.g.
+                `chunksize`, `usecols`, `dtype` and `engine` for csv files, `columns`
+                and `filters` for parquet files, or `columns` for feather
+                files. When `chunksize` is set, Filly.data is a
+                `pd.io.parsers.TextFileReader` yielding dataframes of
+                `chunksize` rows instead of a single dataframe.
+        """
 
         self.__set_path(filepath, filename, fullpath)
+        self._check_handler()
 
         if download:
             # Download data if it is in a remote location
             if self.remote == 'hdfs':
-                self._download_from_hdfs(hdfs_dir)
+                self._download_from_hdfs(self.filepath)
             elif self.remote == 's3':
                 self.s3.get_from_s3(self.filepath, self.filepath, self.filename)
             else:
                 pass;
 
-        self._read_or_write(mode='r', data=None)
+        self._read_or_write(mode='r', data=None, **kwargs)
 
+    def read_many(self, specs, max_workers=None):
+        """Read many files concurrently and return their data in the same order
 
-    def _upload_to_hdfs(self, hdfs_dir):
-        """Upload local file to HDFS, replace if exists."""
+        Arguments:
+            specs (list of dict): keyword arguments for `read_data`, one dict per file
+            max_workers (int): default to `MAX_WORKERS`. Number of files read at once.
+
+        Returns:
+            list: the data read from each file
+        """
+
+        n_workers = max_workers or self.MAX_WORKERS
+        batch = self._for_workers(n_workers)
+
+        def read_one(spec):
+            worker = copy.copy(batch)
+            worker.read_data(**spec)
+            return worker.data
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(read_one, specs))
+
+    def write_many(self, specs, max_workers=None):
+        """Write many files concurrently
+
+        Arguments:
+            specs (list of dict): keyword arguments for `write_data`, including
+                `data`, one dict per file
+            max_workers (int): default to `MAX_WORKERS`. Number of files written at once.
+        """
+
+        n_workers = max_workers or self.MAX_WORKERS
+        batch = self._for_workers(n_workers)
 
-        ret, _, err = self.__run_cmd(['hdfs', 'dfs', '-test', '-e', hdfs_dir])
+        def write_one(spec):
+            copy.copy(batch).write_data(**spec)
 
-        if not ret:
-            ret, _, err = self.__run_cmd(['hdfs', 'dfs', '-rm', hdfs_dir])
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(write_one, specs))
 
-        ret, _, err = self.__run_cmd(['hdfs', 'dfs', '-copyFromLocal', self.fullpath, hdfs_dir])
+    def _for_workers(self, n_workers):
+        """Copy of this Filly for `n_workers` threads, whose s3 transfers
+        share the client's connection pool instead of each using
+        `S3.MAX_CONCURRENCY` threads"""
 
-        if err:
+        batch = copy.copy(self)
+        if self.remote == 's3':
+            batch.s3 = self.s3.for_workers(n_workers)
+        return batch
+
+    def _upload_to_hdfs(self, hdfs_dir):
+        """Upload local file to HDFS, replace if exists."""
+
+        from pyarrow import fs
+
+        try:
+            if hdfs_dir:
+                self.hdfs.create_dir(hdfs_dir, recursive=True)
+            fs.copy_files(
+                self.fullpath,
+                os.path.join(hdfs_dir, self.filename),
+                source_filesystem=fs.LocalFileSystem(),
+                destination_filesystem=self.hdfs,
+            )
+        except OSError as err:
             self.logger.error(err)
-        else:
-            self.logger.info(f'File {self.fullpath} uploaded successfully to {hdfs_dir}.')
+            raise FileUploadError(self.filename, hdfs_dir, str(err)) from err
+
+        self.logger.info('File %s uploaded successfully to %s.', self.fullpath, hdfs_dir)
 
     def _download_from_hdfs(self, hdfs_dir):
-        """Upload local file to HDFS, replace if exists."""
+        """Download file from HDFS to local, replace if exists."""
 
-        if os.path.isfile(self.fullpath):
-            os.remove(self.fullpath)
+        from pyarrow import fs
 
-        _, _, err = self.__run_cmd([
-            'hdfs', 'dfs', '-copyToLocal', os.path.join(hdfs_dir, self.filename), self.fullpath
-        ])
-        if err:
-            self.logger.error(err)
+        self._ensure_dir()
+
+        fs.copy_files(
+            os.path.join(hdfs_dir, self.filename),
+            self.fullpath,
+            source_filesystem=self.hdfs,
+            destination_filesystem=fs.LocalFileSystem(),
+        )
+        self.logger.info('File %s downloaded successfully from %s.', self.fullpath, hdfs_dir)
+
+    @contextmanager
+    def _open_output(self):
+        """Open the binary file object the handlers write to, either the
+        caller's buffer, the local file or an s3 upload stream when no local
+        copy is kept"""
+
+        if self._buffer is not None:
+            yield self._buffer
+        elif self._keep_local:
+            with open(self.fullpath, 'wb') as output:
+                yield output
+            self.logger.info('Data saved at %s', self.fullpath)
         else:
-            self.logger.info(f'File {self.fullpath} downloaded successfully from {hdfs_dir}.')
+            with self.s3.open_writer(self.filepath, self.filename) as output:
+                yield output
 
-    def _read_or_write(self, mode, data=None):
+    def _read_or_write(self, mode, data=None, **kwargs):
         """Wrapper to decide how to read/write the file based on file type
 
         Parameters
@@ -163,43 +346,99 @@ class Filly():
                 data must also be supplied when instantiating the object
         data (dict, pd.DataFrame):
             data to be written. Only need to be supplied when mode='w'
+        **kwargs:
+            extra reader options, passed on to the file type handler
         """
 
-        file_extension = Path(self.filename).suffix
-
         if bool(mode):
-            if file_extension == '.json':
-                self._json_handler(mode, data)
-
-            elif file_extension == '.csv':
-                self._csv_handler(mode, data)
-
-            elif file_extension in ['.pkl', '.pickle']:
-                self._pickle_handler(mode, data)
-
-            else:
-                raise TypeError('File type: {file_extension} not supported')
+            getattr(self, self._handler)(mode, data, **kwargs)
 
     def _json_handler(self, mode, data):
-        """Either read json data as dictionary, or save dictionary as json"""
+        """Either read json data as dictionary, or save dictionary as json
+
+        Writes compact json with ``orjson`` when it is installed, which unlike
+        the standard library ``json`` module writes NaN and infinity as null and
+        non-ascii characters as raw UTF-8. Reads always use ``json``, since
+        ``orjson`` rejects NaN and turns integers beyond 64 bits into floats.
+        """
 
         if mode == 'r':
-            self.data = json.loads(open(self.fullpath, "r").read())
+            with open(self.fullpath, 'rb', buffering=1 << 20) as json_file:
+                self.data = json.loads(json_file.read())
 
         elif mode == 'w':
-            with open(self.fullpath, 'w') as json_file:
-                json.dump(data, json_file)
-            self.logger.info(f'Json data saved at {self.fullpath}')
+            with self._open_output() as json_file:
+                json_file.write(_json_dumps(data))
 
-    def _csv_handler(self, mode, data):
-        """Either read csv as pandas dataframe, or write pandas dataframe as csv"""
+    def _csv_handler(self, mode, data, chunksize=None, usecols=None, dtype=None, engine=None):
+        """Either read csv as pandas dataframe, or write pandas dataframe as csv
+
+        Large files can be read in chunks of `chunksize` rows, or of
+        `CSV_CHUNKSIZE` rows with `chunksize=True`, in which case Filly.data is
+        an iterator over dataframes. `usecols` and `dtype` are applied at parse
+        time so unused columns are skipped and dtype inference is avoided.
+
+        With `engine='pyarrow'` whole files are parsed with the multithreaded
+        ``pyarrow`` csv reader, which returns the `usecols` columns in the order
+        given and parses dates. Chunked reads and `usecols` other than a list of
+        column names always use ``pd.read_csv``, as does any other `engine`.
+        """
 
         if mode == 'r':
-            self.data = pd.read_csv(self.fullpath)
+            if chunksize is True:
+                chunksize = self.CSV_CHUNKSIZE
+
+            if engine == 'pyarrow':
+                if chunksize is None and (
+                    usecols is None or
+                    not callable(usecols) and all(isinstance(column, str) for column in usecols)
+                ):
+                    self.data = self._read_csv_arrow(usecols, dtype)
+                    return
+                engine = None
+
+            self.data = pd.read_csv(
+                self.fullpath,
+                chunksize=chunksize,
+                usecols=usecols,
+                dtype=dtype,
+                engine=engine,
+            )
 
         elif mode == 'w':
-            data.to_csv(self.fullpath, index=False)
-            self.logger.info(f'Pandas data saved at {self.fullpath}')
+            with self._open_output() as csv_file:
+                data.to_csv(csv_file, index=False)
+
+    def _read_csv_arrow(self, usecols=None, dtype=None):
+        """Read the whole csv with pyarrow, converting it to a pandas dataframe"""
+
+        import numpy as np
+        import pyarrow as pa
+        from pyarrow import csv
+
+        column_types = {}
+        if isinstance(dtype, dict):
+            for column, column_dtype in dtype.items():
+                try:
+                    column_types[column] = pa.from_numpy_dtype(np.dtype(column_dtype))
+                except (TypeError, pa.ArrowNotImplementedError):
+                    # e.g. 'category', converted by pandas below
+                    pass
+
+        table = csv.read_csv(
+            self.fullpath,
+            read_options=csv.ReadOptions(block_size=self.CSV_BLOCK_SIZE, use_threads=True),
+            convert_options=csv.ConvertOptions(
+                include_columns=usecols,
+                column_types=column_types,
+            ),
+        )
+        data = table.to_pandas(split_blocks=True, self_destruct=True)
+
+        if dtype is not None:
+            data = data.astype(dtype)
+
+        return data
 
     def _pickle_handler(self, mode, data):
         """Either read pickle as pandas dataframe, or write pickle dataframe as csv"""
@@ -208,8 +447,51 @@ class Filly():
             self.data = pd.read_pickle(self.fullpath)
 
         elif mode == 'w':
-            data.to_pickle(self.fullpath)
-            self.logger.info(f'Pandas data saved at {self.fullpath}')
+            with self._open_output() as pickle_file:
+                data.to_pickle(pickle_file)
+
+    def _parquet_handler(self, mode, data, columns=None, filters=None):
+        """Either read parquet as pandas dataframe, or write pandas dataframe as parquet
+
+        Only the requested `columns` are read and row groups are pruned with
+        `filters`, e.g. `[('A', '>', 0)]`, before they are loaded into memory.
+        """
+
+        if mode == 'r':
+            self.data = pd.read_parquet(
+                self.fullpath,
+                engine='pyarrow',
+                columns=columns,
+                filters=filters,
+            )
+
+        elif mode == 'w':
+            with self._open_output() as parquet_file:
+                data.to_parquet(
+                    parquet_file,
+                    engine='pyarrow',
+                    compression='snappy',
+                    row_group_size=1_000_000,
+                )
+
+    def _arrow_handler(self, mode, data, columns=None):
+        """Either read arrow ipc / feather as pandas dataframe, or write pandas dataframe as feather
+
+        The file is memory mapped on read so column buffers are paged in by the
+        kernel instead of being copied. Files are written uncompressed, since
+        compressed buffers have to be decompressed into memory and cannot be
+        mapped.
+        """
+
+        from pyarrow import feather
+
+        if mode == 'r':
+            table = feather.read_table(self.fullpath, columns=columns, memory_map=True)
+            self.data = table.to_pandas(split_blocks=True, self_destruct=True)
+
+        elif mode == 'w':
+            with self._open_output() as arrow_file:
+                feather.write_feather(data, arrow_file, compression='uncompressed')
 
     def write_output(self, data, filename=None, filepath=None, fullpath=None):
 
@@ -218,15 +500,28 @@ class Filly():
         with open(self.fullpath, 'w') as results_file:
             results_file.write(data)
 
-        self.logger.info('Results written to {self.fullpath}')
+        self.logger.info('Results written to %s', self.fullpath)
 
-    def read_input(self, filename=None, filepath=None, fullpath=None):
+    def read_input(self, filename=None, filepath=None, fullpath=None, raw=False):
+        """Read a text file and return its content
+
+        With `raw` set, the file is memory mapped read-only instead and a
+        `memoryview` of it is returned, so pages are only loaded as they are
+        touched. It can be passed as bytes to parsers such as `orjson.loads`
+        without a copy, and should be released by the caller with `.release()`
+        or a `with` block, which unmaps the file once no other references to it
+        remain. Empty files, which cannot be mapped, give an empty `memoryview`.
+        """
 
-        output = ''
         self.__set_path(filepath, filename, fullpath)
 
-        with open(self.fullpath, 'r') as results_file:
-            for line in results_file:
-                output += line
+        if raw:
+            with open(self.fullpath, 'rb') as results_file:
+                if os.fstat(results_file.fileno()).st_size == 0:
+                    return memoryview(b'')
+                return memoryview(
+                    mmap.mmap(results_file.fileno(), 0, access=mmap.ACCESS_READ)
+                )
 
-        return output
\ No newline at end of file
+        with open(self.fullpath, 'r', buffering=1 << 20) as results_file:
+            return results_file.read()
@@ -11,67 +11,257 @@ Usage:
 
 # pylint: disable=no-value-for-parameter
 
+import io
 import os
+import copy
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import threading
+import queue
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from tqdm import tqdm
 from .log import setup_custom_logger
 
 logger = setup_custom_logger(__name__)
 
+MAX_POOL_CONNECTIONS = 64
+
+_CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    tcp_keepalive=True
+)
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """ Return the s3 client shared by all S3 instances, creating it on first
+    use. Its connection pool is sized for the concurrent transfers below and
+    connections are kept alive between calls.
+
+    """
+
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = boto3.client('s3', config=_CLIENT_CONFIG)
+
+    return _client
+
+
+class S3Writer(io.RawIOBase):
+    """ Binary file object that streams everything written to it into an S3
+    multipart upload, sending a part every `part_size` bytes.
+
+    Closing the writer uploads the last part and completes the upload, and
+    `abort` discards it. Use `S3.open_writer` rather than creating it directly.
+
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self._buffer = bytearray()
+        self._parts = []
+        self._upload_id = self.s3_client.create_multipart_upload(
+            Bucket=bucket,
+            Key=key
+        )['UploadId']
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+
+        return len(b)
+
+    def _upload_part(self, body):
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=bytes(body)
+        )
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def close(self):
+        if self.closed:
+            return
+
+        if self._buffer or not self._parts:
+            self._upload_part(self._buffer)
+            self._buffer.clear()
+
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            MultipartUpload={'Parts': self._parts}
+        )
+        super().close()
+
+    def abort(self):
+        if self.closed:
+            return
+
+        self.s3_client.abort_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id
+        )
+        self._buffer.clear()
+        super().close()
+
+
 class S3:
 
+    MAX_WORKERS = 32
+    QUEUE_SIZE = 1024
+    MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+    MAX_CONCURRENCY = 16
+
     def __init__(self, bucket):
-        self.s3_client = boto3.client('s3')
+        self.s3_client = get_s3_client()
         self.bucket = bucket
+        self.transfer_config = TransferConfig(
+            multipart_threshold=self.MULTIPART_THRESHOLD,
+            multipart_chunksize=self.MULTIPART_CHUNKSIZE,
+            max_concurrency=self.MAX_CONCURRENCY,
+            use_threads=True
+        )
 
-    def get_blob_references_from_s3(self, remote_dir) -> zip:
-        """ Download all files from the remote directory to local, using
-        the same file structure as the remote.
+    def _pooled_transfer_config(self, n_workers):
+        """ Transfer config giving each of `n_workers` concurrent transfers an
+        equal share of the client's `MAX_POOL_CONNECTIONS` connections.
 
         """
 
-        next_token = ''
-        keys = []
-        base_kwargs = {
-            'Bucket': self.bucket,
-            'Prefix': remote_dir,
-        }
+        return TransferConfig(
+            multipart_threshold=self.MULTIPART_THRESHOLD,
+            multipart_chunksize=self.MULTIPART_CHUNKSIZE,
+            max_concurrency=max(1, min(self.MAX_CONCURRENCY, MAX_POOL_CONNECTIONS // n_workers)),
+            use_threads=True
+        )
+
+    def for_workers(self, n_workers):
+        """ Return a copy sharing this client whose single file transfers use
+        a pooled transfer config, for `n_workers` threads calling
+        `get_from_s3` or `put_to_s3` at once.
+
+        """
+
+        shared = copy.copy(self)
+        shared.transfer_config = self._pooled_transfer_config(n_workers)
+        return shared
+
+    def get_blob_references_from_s3(self, remote_dir) -> list:
+        """ List the keys of all files under the remote directory.
+
+        """
 
-        while next_token is not None:
-            kwargs = base_kwargs.copy()
-            if next_token != '':
-                kwargs.update({'ContinuationToken': next_token})
-            results = self.s3_client.list_objects_v2(**kwargs)
-            contents = results.get('Contents')
+        return list(self.iter_blob_references_from_s3(remote_dir))
 
-            keys += [content.get('Key') for content in contents]
-            next_token = results.get('NextContinuationToken')
+    def iter_blob_references_from_s3(self, remote_dir):
+        """ Yield the keys of all files under the remote directory, one listing
+        page at a time, so callers can start on the first keys before the
+        listing has finished.
 
-        return keys
+        """
+
+        paginator = self.s3_client.get_paginator('list_objects_v2')
 
-    def get_all_from_s3(self, remote_dir: str):
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=remote_dir):
+            for content in page.get('Contents', ()):
+                yield content['Key']
+
+    def get_all_from_s3(self, remote_dir: str, max_workers: int = None, callback=None):
         """ Download all files from the remote directory to local, using
         the same file structure as the remote.
 
+        Listing, downloading and processing are pipelined: keys are put on a
+        bounded queue as soon as each listing page arrives, and up to
+        `max_workers` threads (defaulting to `MAX_WORKERS`) download them
+        while the listing continues. If `callback` is given it is called with
+        the local path of every file straight after its download, in the
+        same worker thread.
+
+        Each download gets an equal share of the client's connection pool for
+        its multipart transfer, so all workers together never use more than
+        `MAX_POOL_CONNECTIONS` connections.
+
         """
 
-        blobs = self.get_blob_references_from_s3(self.bucket, remote_dir)
+        n_workers = max_workers or self.MAX_WORKERS
+        blobs = queue.Queue(maxsize=self.QUEUE_SIZE)
+        errors = []
+        progress = tqdm(desc='From S3: ')
+        transfer_config = self._pooled_transfer_config(n_workers)
+
+        def worker():
+            while True:
+                blob = blobs.get()
+                if blob is None:
+                    return
+                try:
+                    self._download_blob(blob, transfer_config)
+                except Exception as err:
+                    errors.append(err)
+                    logger.error('Failed to download %s: %s', blob, err)
+                else:
+                    if callback is not None:
+                        try:
+                            callback(blob)
+                        except Exception as err:
+                            errors.append(err)
+                            logger.error('Callback failed for %s: %s', blob, err)
+                progress.update()
+
+        logger.info('Start downloading files from s3://%s/%s.', self.bucket, remote_dir)
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for _ in range(n_workers):
+                executor.submit(worker)
+            try:
+                for blob in self.iter_blob_references_from_s3(remote_dir):
+                    blobs.put(blob)
+            finally:
+                for _ in range(n_workers):
+                    blobs.put(None)
 
-        logger.info(f'Start downloading {len(blobs)} files from S3.')
+        progress.close()
 
-        for blob in tqdm(blobs, desc='From S3: ', total=len(blobs)):
+        if errors:
+            raise errors[0]
 
-            if not os.path.exists(os.path.dirname(blob)):
-                os.makedirs(os.path.dirname(blob))
+        logger.info('Completed download of ALL %d files.', progress.n)
 
-            self.s3_client.download_file(
-                self.bucket,
-                blob,
-                blob
-            )
+    def _download_blob(self, blob, transfer_config):
+        """ Download a single blob to the same path locally """
 
-        logger.info(f'Completed download of ALL image files.')
+        if os.path.dirname(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+
+        self.s3_client.download_file(
+            self.bucket,
+            blob,
+            blob,
+            Config=transfer_config
+        )
 
     def get_from_s3(self, remote_dir, local_dir, filename):
 
@@ -79,9 +269,10 @@ class S3:
         self.s3_client.download_file(
             self.bucket,
             os.path.join(remote_dir, filename),
-            current_fpath
+            current_fpath,
+            Config=self.transfer_config
         )
-        logger.info(f'Completed file download to {current_fpath}')
+        logger.info('Completed file download to %s', current_fpath)
 
     def put_to_s3(self, local_dir, remote_dir, filename):
 
@@ -89,9 +280,37 @@ class S3:
         self.s3_client.upload_file(
             os.path.join(local_dir, filename),
             self.bucket,
-            upload_fpath
+            upload_fpath,
+            Config=self.transfer_config
         )
 
         logger.info(
-            f'Completed file upload to s3://{self.bucket}/{upload_fpath}'
+            'Completed file upload to s3://%s/%s', self.bucket, upload_fpath
+        )
+
+    @contextmanager
+    def open_writer(self, remote_dir, filename):
+        """ Open a binary file object that is streamed straight to S3, without
+        a local copy. The upload is aborted if the block or completing the upload
+        raises.
+
+        """
+
+        upload_fpath = os.path.join(remote_dir, filename)
+        writer = S3Writer(
+            self.s3_client,
+            self.bucket,
+            upload_fpath,
+            self.MULTIPART_CHUNKSIZE
+        )
+
+        try:
+            yield writer
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+
+        logger.info(
+            'Completed file upload to s3://%s/%s', self.bucket, upload_fpath
         )
@@ -2,14 +2,20 @@
 
 """Tests for `filly` package."""
 
+import io
 import os
 import sys
+import mmap
+import json
 import pytest
 from contextlib import nullcontext
+import numpy as np
 import pandas as pd
 from pandas._testing import assert_frame_equal
 # from click.testing import CliRunner
 
+from filly import filly as filly_module
+from filly import s3 as s3_module
 from filly.filly import Filly, FileUploadError
 from filly import cli
 
@@ -27,9 +33,37 @@ from filly import cli
 
 ## TODO: mock S3
 
-@pytest.fixture
-def df():
-    return pd.read_csv('tests/data/test.csv')
+def read_ref_csv(path):
+    """Read back a written reference frame with the C parser and known dtypes"""
+    return pd.read_csv(path, engine='c', dtype={'A': 'int64', 'B': 'int64', 'C': 'int64'})
+
+
+def assert_matches(expected, result):
+    """Compare dataframes exactly, including dtypes, and anything else by equality"""
+    if isinstance(expected, pd.DataFrame):
+        assert expected.equals(result)
+    else:
+        assert expected == result
+
+
+@pytest.fixture(scope="session")
+def ref_df():
+    return pd.DataFrame({
+        "A": np.full(3, 0, dtype=np.int64),
+        "B": np.full(3, 1, dtype=np.int64),
+        "C": np.full(3, 2, dtype=np.int64)
+    })
+
+
+@pytest.fixture(scope="session")
+def ref_json():
+    return {"A": 1, "B": 2, "C": 3}
+
+
+@pytest.fixture(scope="session")
+def local_filly():
+    """A local Filly shared by the read-only tests, each read replaces its data"""
+    return Filly(remote=None)
 
 
 @pytest.mark.parametrize(
@@ -43,7 +77,8 @@ def df():
                 match='Upload failed for File valid_name upload to valid_path'
             )
         )
-    ]
+    ],
+    ids=['not_raised', 'raised']
 )
 def test_file_upload_error(filename, filepath, to_raise, expected_raises):
 
@@ -51,11 +86,18 @@ def test_file_upload_error(filename, filepath, to_raise, expected_raises):
         with expected_raises:
             raise FileUploadError(filename, filepath)
 
+def test_file_upload_error_message():
+
+    err = FileUploadError('valid_name', 'valid_path', 'Permission denied')
+
+    assert str(err) == 'Upload failed for File valid_name upload to valid_path. Permission denied'
+
 @pytest.mark.parametrize(
     "remote, bucket_name", [
         ('s3', None),
         ('s3', '')
-    ]
+    ],
+    ids=['no_bucket', 'empty_bucket']
 )
 def test_remote(remote, bucket_name):
     with pytest.raises(ValueError):
@@ -64,150 +106,494 @@ def test_remote(remote, bucket_name):
             bucket_name=bucket_name
         )
 
+@pytest.mark.parametrize("target", ['buffer', 'fullpath'])
 @pytest.mark.parametrize(
-    "filename, filepath, fullpath, mode",
+    "filename, ref, reader",
     [
-        ('test_csv.csv', 'tests/data/', None, 'w'),
-        ('test_csv_read.csv', 'tests/data/', None, 'r'),
-        (None, None, 'tests/data/test_csv_read.csv', 'r')
-    ]
+        ('test_csv.csv', 'ref_df', read_ref_csv),
+        ('test_pickle.pkl', 'ref_df', pd.read_pickle),
+        ('test_json.json', 'ref_json', json.load)
+    ],
+    ids=['csv', 'pickle', 'json']
 )
-def test_csv_handler(filename, filepath, fullpath, mode):
+def test_write_handler(filename, ref, reader, target, request, tmp_path):
 
-    dict1 = pd.DataFrame({
-        "A": [0,0,0],
-        "B": [1,1,1],
-        "C": [2,2,2]
-    })
+    expected = request.getfixturevalue(ref)
 
-    if mode == 'w':
-        try:
-            file_handler = Filly()
-            file_handler.write_data(
-                filename=filename,
-                filepath=filepath,
-                fullpath=fullpath,
-                data=dict1
-            )
-            dict2 = pd.read_csv(open(os.path.join(filepath, filename), 'r'))
-            assert_frame_equal(dict1, dict2)
-        except Exception as err:
-            print(err)
-        finally:
-            os.remove(file_handler.fullpath)
+    if target == 'buffer':
+        output = io.BytesIO()
+        Filly().write_data(filename=filename, data=expected, buffer=output)
+        output.seek(0)
+    else:
+        fullpath = tmp_path / 'nested' / filename
+        Filly().write_data(fullpath=str(fullpath), data=expected)
+        output = open(fullpath, 'rb')
+
+    with output:
+        assert_matches(expected, reader(output))
 
-    elif mode == 'r':
+@pytest.mark.parametrize(
+    "dumps",
+    [
+        filly_module._stdlib_json_dumps,
+        pytest.param(
+            filly_module._orjson_dumps,
+            marks=pytest.mark.skipif(filly_module.orjson is None, reason='orjson not installed')
+        )
+    ],
+    ids=['json', 'orjson']
+)
+@pytest.mark.parametrize(
+    "data, expected",
+    [
+        ({1: 'a'}, b'{"1":"a"}'),
+        ({"A": 12345678901234567890123}, b'{"A":12345678901234567890123}'),
+        ({"A": None}, b'{"A":null}')
+    ],
+    ids=['int_key', 'big_int', 'null']
+)
+def test_json_dumps(dumps, data, expected, tmp_path):
 
-        file_handler = Filly(remote=None)
-        file_handler.read_data(filename=filename, filepath=filepath, fullpath=fullpath)
-        assert_frame_equal(file_handler.data, dict1)
+    assert dumps(data) == expected
+
+    (tmp_path / 'test.json').write_bytes(dumps(data))
+    file_handler = Filly()
+    file_handler.read_data(filename='test.json', filepath=str(tmp_path))
+    assert json.dumps(file_handler.data) == json.dumps(json.loads(expected))
 
 @pytest.mark.parametrize(
-    "filename, filepath, fullpath, mode",
+    "dumps, expected",
     [
-        ('test_pickle.pkl', 'tests/data/', None,'w'),
-        ('test_pickle_read.pkl', 'tests/data/', None, 'r'),
-        (None, None, 'tests/data/test_pickle.pkl', 'w'),
-        (None, None, 'tests/data/test_pickle_read.pkl', 'r')
-    ]
+        (filly_module._stdlib_json_dumps, b'{"A":NaN}'),
+        pytest.param(
+            filly_module._orjson_dumps, b'{"A":null}',
+            marks=pytest.mark.skipif(filly_module.orjson is None, reason='orjson not installed')
+        )
+    ],
+    ids=['json', 'orjson']
+)
+def test_json_dumps_nan(dumps, expected):
+
+    assert dumps({"A": float('nan')}) == expected
+
+@pytest.mark.parametrize(
+    "filename, filepath, fullpath, ref",
+    [
+        ('test_csv_read.csv', 'tests/data/', None, 'ref_df'),
+        (None, None, 'tests/data/test_csv_read.csv', 'ref_df'),
+        ('test_pickle_read.pkl', 'tests/data/', None, 'ref_df'),
+        (None, None, 'tests/data/test_pickle_read.pkl', 'ref_df'),
+        ('test_json_read.json', 'tests/data/', None, 'ref_json')
+    ],
+    ids=['csv_split', 'csv_fullpath', 'pickle_split', 'pickle_fullpath', 'json_split']
+)
+def test_read_handler(filename, filepath, fullpath, ref, request, local_filly):
+
+    expected = request.getfixturevalue(ref)
+    local_filly.read_data(filename=filename, filepath=filepath, fullpath=fullpath)
+
+    assert_matches(expected, local_filly.data)
+
+@pytest.mark.parametrize("chunksize", [1, 2, 3])
+def test_csv_handler_chunksize(chunksize, ref_df, local_filly):
+
+    local_filly.read_data(
+        fullpath='tests/data/test_csv_read.csv',
+        chunksize=chunksize,
+        usecols=['A', 'C'],
+        dtype={'A': 'int64', 'C': 'int64'}
+    )
+    chunks = list(local_filly.data)
+
+    assert all(len(chunk) <= chunksize for chunk in chunks)
+    assert pd.concat(chunks, ignore_index=True).equals(ref_df[['A', 'C']])
+
+def test_csv_handler_default_chunksize(ref_df, local_filly, monkeypatch):
+
+    monkeypatch.setattr(Filly, 'CSV_CHUNKSIZE', 2)
+    local_filly.read_data(fullpath='tests/data/test_csv_read.csv', chunksize=True)
+    chunks = list(local_filly.data)
+
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert pd.concat(chunks, ignore_index=True).equals(ref_df)
+
+@pytest.mark.parametrize("engine", [None, 'pyarrow'])
+@pytest.mark.parametrize(
+    "usecols",
+    [['A', 'C'], [0, 2], lambda column: column != 'B'],
+    ids=['names', 'positions', 'callable']
 )
-def test_pickle_handler(filename, filepath, fullpath, mode):
+def test_csv_handler_usecols(usecols, engine, ref_df, local_filly):
+    if engine == 'pyarrow':
+        pytest.importorskip('pyarrow')
+
+    local_filly.read_data(fullpath='tests/data/test_csv_read.csv', usecols=usecols, engine=engine)
+    assert_frame_equal(local_filly.data, ref_df[['A', 'C']])
+
+def test_csv_handler_arrow_dtype(local_filly):
+    pytest.importorskip('pyarrow')
+
+    local_filly.read_data(
+        fullpath='tests/data/test_csv_read.csv',
+        dtype={'A': 'int32', 'B': 'float64', 'C': 'category'},
+        engine='pyarrow'
+    )
+
+    assert local_filly.data.dtypes.to_dict() == {
+        'A': np.dtype('int32'),
+        'B': np.dtype('float64'),
+        'C': pd.CategoricalDtype([2]),
+    }
+    assert local_filly.data['C'].tolist() == [2, 2, 2]
+
+@pytest.mark.parametrize("filename", ['test_parquet.parquet', 'test_parquet.pq'])
+def test_parquet_handler(filename, tmp_path):
+    pytest.importorskip('pyarrow')
 
     dict1 = pd.DataFrame({
-        "A": [0,0,0],
-        "B": [1,1,1],
-        "C": [2,2,2]
+        "A": np.arange(3, dtype=np.int64),
+        "B": np.full(3, 1, dtype=np.int64),
+        "C": np.full(3, 2, dtype=np.int64)
     })
 
-    if mode == 'w':
-        try:
-            file_handler = Filly()
-            file_handler.write_data(
-                filename=filename,
-                filepath=filepath,
-                fullpath=fullpath,
-                data=dict1
-            )
-            dict2 = pd.read_csv(open(os.path.join(filepath, filename), 'r'))
-            assert_frame_equal(dict1, dict2)
-        except Exception as err:
-            print(err)
-        finally:
-            os.remove(file_handler.fullpath)
+    file_handler = Filly()
+    file_handler.write_data(filename=filename, filepath=str(tmp_path), data=dict1)
+
+    file_handler.read_data(filename=filename, filepath=str(tmp_path))
+    assert file_handler.data.equals(dict1)
 
-    elif mode == 'r':
+    file_handler.read_data(
+        filename=filename,
+        filepath=str(tmp_path),
+        columns=['A', 'B'],
+        filters=[('A', '>', 0)]
+    )
+    assert file_handler.data.reset_index(drop=True).equals(
+        dict1.loc[dict1.A > 0, ['A', 'B']].reset_index(drop=True)
+    )
 
-        file_handler = Filly(remote=None)
-        file_handler.read_data(filename=filename, filepath=filepath, fullpath=fullpath)
-        assert_frame_equal(file_handler.data, dict1)
+@pytest.mark.parametrize("filename", ['test_arrow.feather', 'test_arrow.arrow'])
+def test_arrow_handler(filename, ref_df, tmp_path):
+    pytest.importorskip('pyarrow')
+
+    file_handler = Filly()
+    file_handler.write_data(filename=filename, filepath=str(tmp_path), data=ref_df)
+
+    file_handler.read_data(filename=filename, filepath=str(tmp_path))
+    assert file_handler.data.equals(ref_df)
+
+    file_handler.read_data(filename=filename, filepath=str(tmp_path), columns=['C'])
+    assert file_handler.data.equals(ref_df[['C']])
+
+def test_read_many_write_many(tmp_path):
+
+    frames = [pd.DataFrame({"A": [i, i], "B": [1, 1]}) for i in range(4)]
+    filenames = [f'test_many_{i}.csv' for i in range(len(frames))]
+
+    file_handler = Filly()
+    file_handler.write_many([
+        {'filename': filename, 'filepath': str(tmp_path), 'data': frame}
+        for filename, frame in zip(filenames, frames)
+    ])
+    data = file_handler.read_many([
+        {'filename': filename, 'filepath': str(tmp_path)} for filename in filenames
+    ], max_workers=2)
+
+    assert len(data) == len(frames)
+    for frame, read in zip(frames, data):
+        assert read.equals(frame)
+
+@pytest.mark.parametrize("filename", ['test.txt', 'test'])
+def test_unsupported_file_type(filename):
+
+    with pytest.raises(TypeError, match='not supported'):
+        Filly().read_data(filename=filename, filepath='tests/data/')
 
 @pytest.mark.parametrize(
-    "filename, filepath, mode",
+    "filename, use_filepath, data",
     [
-        ('test_json.json', 'tests/data/', 'w'),
-        ('test_json_read.json', 'tests/data/', 'r')
-    ]
+        ('tmp', True, 'true'),
+        (None, False, 'true')
+    ],
+    ids=['split', 'fullpath']
 )
-def test_json_handler(filename, filepath, mode):
+def test_write_output(filename, use_filepath, data, tmp_path):
 
-    dict1 = {"A": 1, "B": 2, "C": 3}
+    fullpath = str(tmp_path / 'tmp')
+    file_handler = Filly()
+    file_handler.write_output(
+        data=data,
+        filepath=str(tmp_path) if use_filepath else None,
+        filename=filename,
+        fullpath=fullpath
+    )
 
-    if mode == 'w':
-        try:
-            file_handler = Filly()
-            file_handler.write_data(
-                filename=filename,
-                filepath=filepath,
-                data=dict1
-            )
-            dict2 = json.loads(open(os.path.join(filepath, filename), 'r').read())
-            assert dict1 == dict2
-        except Exception as err:
-            print(err)
-        finally:
-            os.remove(file_handler.fullpath)
+    with open(fullpath, 'rb') as results_file, \
+            mmap.mmap(results_file.fileno(), 0, access=mmap.ACCESS_READ) as output:
+        assert output[:] == data.encode()
 
-    elif mode == 'r':
 
-        file_handler = Filly(remote=None)
-        file_handler.read_data(filename=filename, filepath=filepath)
-        assert file_handler.data == dict1
+@pytest.mark.parametrize("content", ['true', ''], ids=['text', 'empty'])
+def test_read_input(content, tmp_path):
+
+    (tmp_path / 'tmp').write_text(content)
+
+    tmp = Filly().read_input(filepath=str(tmp_path), filename='tmp')
+
+    assert tmp == content
+
+    with Filly().read_input(filepath=str(tmp_path), filename='tmp', raw=True) as tmp:
+        assert isinstance(tmp, memoryview)
+        assert tmp == content.encode()
+
+@pytest.fixture
+def local_hdfs(tmp_path, monkeypatch):
+    """A Filly with an hdfs remote backed by a local directory, run from an
+    empty working directory"""
+    fs = pytest.importorskip('pyarrow.fs')
+
+    (tmp_path / 'local').mkdir()
+    (tmp_path / 'remote').mkdir()
+    monkeypatch.chdir(tmp_path / 'local')
+
+    filly = Filly()
+    filly.remote = 'hdfs'
+    filly.hdfs = fs.SubTreeFileSystem(str(tmp_path / 'remote'), fs.LocalFileSystem())
+    return filly
 
 
 @pytest.mark.parametrize(
-    "filename, filepath, fullpath, data",
+    "filepath, filename, fullpath",
     [
-        ('tmp', 'tests/data/', 'tests/data/tmp', 'true'),
-        (None, None, 'tests/data/tmp', 'true')
-    ]
+        ('data/nested', 'test.csv', None),
+        (None, None, 'test.csv')
+    ],
+    ids=['split', 'bare_fullpath']
 )
-def test_write_output(filename, filepath, fullpath, data):
+def test_hdfs_round_trip(filepath, filename, fullpath, local_hdfs, ref_df, tmp_path):
 
-    file_handler = Filly()
-    file_handler.write_output(data=data, filepath=filepath, filename=filename, fullpath=fullpath)
+    local_hdfs.write_data(data=ref_df, filepath=filepath, filename=filename, fullpath=fullpath)
 
-    output = ''
-    with open(fullpath, 'r') as results_file:
-        for line in results_file:
-            output += line
+    remote_file = tmp_path / 'remote' / local_hdfs.fullpath
+    assert read_ref_csv(remote_file).equals(ref_df)
 
-    assert output == data
+    os.remove(local_hdfs.fullpath)
+    local_hdfs.read_data(filepath=filepath, filename=filename, fullpath=fullpath)
+    assert local_hdfs.data.equals(ref_df)
 
 
-def test_read_input():
+class StubS3Client:
+    """Stands in for the boto3 s3 client. It has no methods, so any call that
+    would reach s3 fails instead of touching the network."""
 
-    tmp = Filly().read_input(filepath='tests/data', filename='tmp')
 
-    assert tmp == 'true'
+@pytest.fixture
+def stub_s3_client(monkeypatch):
+    client = StubS3Client()
+    monkeypatch.setattr('filly.s3.get_s3_client', lambda: client)
+    return client
 
-def test_read_data():
 
-    dict1 = pd.DataFrame({
-        "A": [0,0,0],
-        "B": [1,1,1],
-        "C": [2,2,2]
-    })
+def test_read_data(ref_df, stub_s3_client):
 
     filly = Filly(remote='s3', bucket_name='tmp')
+    assert filly.s3.s3_client is stub_s3_client
+
     filly.read_data(filename='test_csv_read.csv', filepath='tests/data', download=False)
-    assert_frame_equal(filly.data, dict1)
+    assert_frame_equal(filly.data, ref_df)
+
+
+class StubS3Multipart(StubS3Client):
+    """Records the parts of multipart uploads and how each upload ended"""
+
+    def __init__(self, fail_complete=False):
+        self.parts = []
+        self.completed = []
+        self.aborted = []
+        self.fail_complete = fail_complete
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts.append(Body)
+        return {'ETag': f'etag{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        if self.fail_complete:
+            raise OSError('Cannot complete upload')
+        self.completed.append((Key, MultipartUpload['Parts']))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(Key)
+
+
+@pytest.fixture
+def stub_s3_multipart(request, monkeypatch):
+    """A StubS3Multipart client, whose uploads fail to complete when the test
+    parametrizes this fixture indirectly with True"""
+    client = StubS3Multipart(fail_complete=getattr(request, 'param', False))
+    monkeypatch.setattr('filly.s3.get_s3_client', lambda: client)
+    return client
+
+
+@pytest.mark.parametrize(
+    "content, parts",
+    [
+        (b'0123456789', [b'0123', b'4567', b'89']),
+        (b'01234567', [b'0123', b'4567']),
+        (b'', [b''])
+    ],
+    ids=['remainder', 'exact', 'empty']
+)
+def test_open_writer(content, parts, stub_s3_multipart):
+
+    client = stub_s3_multipart
+    s3 = s3_module.S3('tmp')
+    s3.MULTIPART_CHUNKSIZE = 4
+
+    with s3.open_writer('remote', 'file.bin') as writer:
+        for start in range(0, len(content), 3):
+            writer.write(content[start:start + 3])
+
+    assert client.parts == parts
+    assert client.completed == [(
+        'remote/file.bin',
+        [{'ETag': f'etag{i}', 'PartNumber': i} for i in range(1, len(parts) + 1)]
+    )]
+    assert client.aborted == []
+
+
+@pytest.mark.parametrize(
+    "stub_s3_multipart", [False, True], ids=['handler', 'complete'], indirect=True
+)
+def test_open_writer_abort(stub_s3_multipart):
+
+    client = stub_s3_multipart
+    filly = Filly(remote='s3', bucket_name='tmp')
+
+    # an object without to_csv makes the csv handler raise mid write
+    fail_complete = client.fail_complete
+    data = pd.DataFrame({'A': [1]}) if fail_complete else object()
+    with pytest.raises(OSError if fail_complete else AttributeError):
+        filly.write_data(data=data, fullpath='remote/test.csv', keep_local=False)
+
+    assert client.completed == []
+    assert client.aborted == ['remote/test.csv']
+
+
+class StubS3Bucket(StubS3Client):
+    """An in memory s3 bucket, listing its keys in pages of `page_size`"""
+
+    def __init__(self, objects, page_size=2):
+        self.objects = objects
+        self.page_size = page_size
+        self.failing_keys = set()
+        self.transfer_configs = []
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        for start in range(0, len(keys), self.page_size):
+            yield {'Contents': [{'Key': key} for key in keys[start:start + self.page_size]]}
+        if not keys:
+            yield {}
+
+    def upload_file(self, filename, bucket, key, Config=None):
+        self.transfer_configs.append(Config)
+        with open(filename, 'rb') as local_file:
+            self.objects[key] = local_file.read()
+
+    def download_file(self, bucket, key, filename, Config=None):
+        self.transfer_configs.append(Config)
+        if key in self.failing_keys:
+            raise OSError(f'Cannot download {key}')
+        with open(filename, 'wb') as local_file:
+            local_file.write(self.objects[key])
+
+
+@pytest.fixture
+def stub_s3_bucket(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    client = StubS3Bucket({
+        f'remote/dir{i % 2}/file{i}.txt': f'content {i}'.encode() for i in range(5)
+    })
+    monkeypatch.setattr('filly.s3.get_s3_client', lambda: client)
+    return client
+
+
+def test_get_all_from_s3(stub_s3_bucket, tmp_path):
+
+    processed = []
+    s3_module.S3('tmp').get_all_from_s3('remote/', max_workers=8, callback=processed.append)
+
+    assert sorted(processed) == sorted(stub_s3_bucket.objects)
+    for key, content in stub_s3_bucket.objects.items():
+        assert (tmp_path / key).read_bytes() == content
+    assert all(
+        config.max_concurrency == s3_module.MAX_POOL_CONNECTIONS // 8
+        for config in stub_s3_bucket.transfer_configs
+    )
+
+
+def test_get_all_from_s3_empty(stub_s3_bucket):
+
+    processed = []
+    s3_module.S3('tmp').get_all_from_s3('missing/', callback=processed.append)
+
+    assert processed == []
+
+
+def test_read_many_write_many_s3(stub_s3_bucket, tmp_path):
+
+    frames = [pd.DataFrame({"A": [i, i], "B": [1, 1]}) for i in range(4)]
+    filenames = [f'test_many_{i}.csv' for i in range(len(frames))]
+
+    file_handler = Filly(remote='s3', bucket_name='tmp')
+    file_handler.write_many([
+        {'filename': filename, 'filepath': 'out', 'data': frame}
+        for filename, frame in zip(filenames, frames)
+    ], max_workers=8)
+    for filename in filenames:
+        os.remove(tmp_path / 'out' / filename)
+    data = file_handler.read_many([
+        {'filename': filename, 'filepath': 'out'} for filename in filenames
+    ], max_workers=8)
+
+    for frame, read in zip(frames, data):
+        assert read.equals(frame)
+    assert len(stub_s3_bucket.transfer_configs) == 2 * len(frames)
+    assert all(
+        config.max_concurrency == s3_module.MAX_POOL_CONNECTIONS // 8
+        for config in stub_s3_bucket.transfer_configs
+    )
+    assert file_handler.s3.transfer_config.max_concurrency == s3_module.S3.MAX_CONCURRENCY
+
+
+@pytest.mark.parametrize("fail", ['download', 'callback'])
+def test_get_all_from_s3_errors(fail, stub_s3_bucket, tmp_path, monkeypatch):
+
+    failing_key = 'remote/dir1/file3.txt'
+    logged = []
+    monkeypatch.setattr(s3_module.logger, 'error', lambda msg, *args: logged.append(msg % args))
+
+    if fail == 'download':
+        stub_s3_bucket.failing_keys.add(failing_key)
+
+    processed = []
+
+    def callback(blob):
+        if fail == 'callback' and blob == failing_key:
+            raise ValueError(f'Cannot process {blob}')
+        processed.append(blob)
+
+    with pytest.raises((OSError, ValueError), match=failing_key):
+        s3_module.S3('tmp').get_all_from_s3('remote/', max_workers=2, callback=callback)
+
+    assert sorted(processed) == sorted(set(stub_s3_bucket.objects) - {failing_key})
+    if fail == 'download':
+        assert logged == [f'Failed to download {failing_key}: Cannot download {failing_key}']
+    else:
+        assert logged == [f'Callback failed for {failing_key}: Cannot process {failing_key}']